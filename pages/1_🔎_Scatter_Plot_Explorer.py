@@ -1,11 +1,42 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
-from scipy import stats
-from sidebar_datainput import show_sidebar_data_input
-from io import StringIO
-import sys
+from sidebar_datainput import show_sidebar_data_input, GENES
+from plot_utils import session_plot
+from sandbox import run_sandbox
+
+# Above this many samples, the uncoloured plot shows point density as hexagonal bins
+# and the coloured/CI plots draw a fixed random sample of this size instead of every point
+MAX_SCATTER_POINTS = 20_000
+
+def _draw_scatter(fig, df, dataset_key, x_gene, y_gene, hue_choice, show_ci):
+    """Draws the interactive scatter plot onto `fig`."""
+    ax = fig.add_subplot()
+    
+    # The reported r still comes from every sample, only the drawn points are subsampled
+    plot_df = df if len(df) <= MAX_SCATTER_POINTS else df.sample(MAX_SCATTER_POINTS, random_state=0)
+    # Use different plot functions based on whether hue is selected; the points are rasterized in every case
+    if hue_choice:
+        sns.scatterplot(data=plot_df, x=x_gene, y=y_gene, hue=hue_choice, ax=ax, alpha=0.8, rasterized=True)
+    elif show_ci:
+        # The CI band is bootstrapped (n_boot=1000 regression fits), so regplot is only used when it is requested
+        sns.regplot(data=plot_df, x=x_gene, y=y_gene, ax=ax, ci=95, scatter_kws={"rasterized": True}, line_kws={"color":"red"})
+    else:
+        # Without the band, the regression line is a closed-form least-squares fit over the data range
+        x, y = df[x_gene].to_numpy(), df[y_gene].to_numpy()
+        slope, intercept = np.polyfit(x, y, 1)
+        x_line = np.array([x.min(), x.max()])
+        if len(x) > MAX_SCATTER_POINTS:
+            fig.colorbar(ax.hexbin(x, y, gridsize=60, cmap='viridis', mincnt=1), ax=ax, label='count')
+        else:
+            ax.scatter(x, y, alpha=0.8, rasterized=True)
+        ax.plot(x_line, slope * x_line + intercept, color='red')
+        ax.set_xlabel(x_gene)
+        ax.set_ylabel(y_gene)
+
+    ax.set_title(f"Relationship between {x_gene} and {y_gene}")
 
 # Page configuration
 st.set_page_config(layout="wide")
@@ -19,7 +50,7 @@ if 'df_full' not in st.session_state:
 
 # Load data from session state
 df = st.session_state['df_full']
-gene_options = [col for col in df.columns if col.startswith('Gene_')]
+dataset_key = st.session_state['dataset_key']
 
 # --- Guided Tour Expander (UPDATED) ---
 with st.expander("LEARN: What is a Scatter Plot?"):
@@ -32,7 +63,7 @@ with st.expander("LEARN: What is a Scatter Plot?"):
         -   **Positive Correlation:** The pattern goes up from left to right. As X increases, Y tends to increase.
         -   **Negative Correlation:** The pattern goes down from left to right. As X increases, Y tends to decrease.
         -   **No Correlation:** The dots look like a random cloud with no clear trend.
-    3.  **Examine the Regression Line:** The line drawn through the points (`sns.regplot` does this) shows the best-fit summary of the linear trend. The shaded area around it is the 95% confidence interval for this line.
+    3.  **Examine the Regression Line:** The line drawn through the points (`sns.regplot` does this) shows the best-fit summary of the linear trend. Tick the confidence band checkbox to add a shaded area around it: the 95% confidence interval for this line.
     4.  **Check the 'r' value:** The Pearson correlation coefficient (r) is a number from -1 to 1 that quantifies the strength of the *linear* relationship. The closer to 1 or -1, the stronger the correlation.
 
     ---
@@ -46,42 +77,39 @@ with st.expander("LEARN: What is a Scatter Plot?"):
 st.header("EXPERIMENT: The Control Panel")
 st.markdown("Choose different genes to see how their relationships change. The 'Gene Correlation' in the Data Lab was set between `Gene_D` and `Gene_E`.")
 
-col1, col2 = st.columns([1, 2])
+# The gene pickers and plot rerun on their own, without touching the sandbox below
+@st.fragment
+def _control_panel():
+    col1, col2 = st.columns([1, 2])
 
-with col1:
-    st.subheader("Parameters")
-    x_gene = st.selectbox("X-axis Gene:", gene_options, index=3) # Default Gene_D
-    y_gene = st.selectbox("Y-axis Gene:", gene_options, index=4) # Default Gene_E
-    
-    # *** THE FIX IS HERE: Add 'Cancer_Subtype' to the hue options ***
-    hue_choice = st.selectbox("Color points by (`hue`):", (None, 'Treatment_Group', 'Cancer_Subtype'), index=0)
-
-    # Calculate correlation for info box
-    try:
-        r_val, p_val = stats.pearsonr(df[x_gene], df[y_gene])
-        st.info(f"The overall Pearson correlation coefficient (r) between these two genes is **{r_val:.3f}**.")
-    except ValueError:
-        st.warning("Could not calculate correlation.")
-        
-with col2:
-    st.subheader("Interactive Plot")
-    fig, ax = plt.subplots(figsize=(8, 6))
-    
-    # Use different plot functions based on whether hue is selected
-    if hue_choice:
-        sns.scatterplot(data=df, x=x_gene, y=y_gene, hue=hue_choice, ax=ax, alpha=0.8)
-    else:
-        sns.regplot(data=df, x=x_gene, y=y_gene, ax=ax, line_kws={"color":"red"})
+    with col1:
+        st.subheader("Parameters")
+        x_gene = st.selectbox("X-axis Gene:", GENES, index=3) # Default Gene_D
+        y_gene = st.selectbox("Y-axis Gene:", GENES, index=4) # Default Gene_E
+
+        # *** THE FIX IS HERE: Add 'Cancer_Subtype' to the hue options ***
+        hue_choice = st.selectbox("Color points by (`hue`):", (None, 'Treatment_Group', 'Cancer_Subtype'), index=0)
+        show_ci = st.checkbox("Show 95% confidence band (`ci=95`)", value=False, disabled=bool(hue_choice), help="Only the regression plot (no `hue`) has a confidence band.")
+
+        # Calculate correlation for info box
+        r_val = st.session_state['corr_mat'].at[x_gene, y_gene]
+        if np.isfinite(r_val):
+            st.info(f"The overall Pearson correlation coefficient (r) between these two genes is **{r_val:.3f}**.")
+        else:
+            st.warning("Could not calculate correlation.")
 
-    ax.set_title(f"Relationship between {x_gene} and {y_gene}", fontsize=16)
-    st.pyplot(fig)
+    with col2:
+        st.subheader("Interactive Plot")
+        st.image(session_plot('scatter', (8, 6), _draw_scatter, df, dataset_key, x_gene, y_gene, hue_choice, show_ci and not hue_choice))
+
+_control_panel()
 
 
 # --- Coding Sandbox ---
 st.header("DISCOVER: The Coding Sandbox")
 st.info("**Scientific Question:** Create a regression plot for `Gene_D` vs. `Gene_E`, but color the individual points by `Cancer_Subtype`. Does the correlation seem to exist within each subtype?")
 
-code_template = f"""
+code_template = """
 import seaborn as sns
 import matplotlib.pyplot as plt
 from scipy import stats
@@ -118,17 +146,12 @@ ax.set_title(f"Correlation colored by Subtype", fontsize=16)
 st.pyplot(fig)
 """
 
-code = st.text_area("Edit your Python code here:", value=code_template, height=400)
-
-if st.button("Run Code", type="primary"):
-    st.subheader("Your Output")
-    old_stdout = sys.stdout
-    sys.stdout = captured_output = StringIO()
-    try:
-        exec(code, {'st': st, 'sns': sns, 'plt': plt, 'stats': stats, 'df': df})
-        console_output = captured_output.getvalue()
-        if console_output:
-            st.code(console_output, language='bash')
-    except Exception as e:
-        st.error(f"🚨 An error occurred:\n{e}")
-    sys.stdout = old_stdout
\ No newline at end of file
+@st.fragment
+def _sandbox():
+    code = st.text_area("Edit your Python code here:", value=code_template, height=400)
+
+    if st.button("Run Code", type="primary"):
+        from scipy import stats
+        run_sandbox(code, {'st': st, 'sns': sns, 'plt': plt, 'stats': stats, 'df': df.copy()})
+
+_sandbox()
@@ -1,10 +1,24 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
-from sidebar_datainput import show_sidebar_data_input
-from io import StringIO
-import sys
+from sidebar_datainput import show_sidebar_data_input, GENES, SUBTYPES
+from plot_utils import session_plot
+from sandbox import run_sandbox
+
+def _draw_violin(fig, df, dataset_key, gene_choice, inner_style, selected_subtypes, use_split):
+    """Draws the interactive violin plot onto `fig`."""
+    # Combine the per-subtype masks stored with the dataset instead of scanning the column with isin
+    subtype_masks = st.session_state['subtype_masks']
+    df_filtered = df[np.logical_or.reduce([subtype_masks[s] for s in selected_subtypes])]
+    ax = fig.add_subplot()
+    sns.violinplot(
+        x='Treatment_Group', y=gene_choice, hue='Cancer_Subtype',
+        hue_order=list(selected_subtypes), data=df_filtered, palette='muted',
+        split=use_split, inner=inner_style, ax=ax
+    )
+    ax.set_title(f'Expression of {gene_choice}')
 
 st.set_page_config(layout="wide")
 show_sidebar_data_input() # This line adds the sidebar to this page
@@ -15,8 +29,7 @@ if 'df_full' not in st.session_state:
     st.stop()
 
 df = st.session_state['df_full']
-gene_options = [col for col in df.columns if col.startswith('Gene_')]
-subtype_options = df['Cancer_Subtype'].unique().tolist()
+dataset_key = st.session_state['dataset_key']
 
 # --- Guided Tour Expander (UPDATED) ---
 with st.expander("LEARN: What is a Violin Plot?"):
@@ -38,36 +51,33 @@ with st.expander("LEARN: What is a Violin Plot?"):
     """)
 
 st.header("EXPERIMENT: The Control Panel")
-col1, col2 = st.columns([1, 2])
-with col1:
-    st.subheader("Parameters")
-    gene_choice = st.selectbox("Choose a Gene (`y`):", gene_options, index=1)
-    inner_style = st.selectbox("Inner plot style (`inner`):", ('box', 'quartile', 'point', 'stick'), index=0)
-    selected_subtypes = st.multiselect("Choose Subtypes to Compare (`hue`):", options=subtype_options, default=subtype_options[:2])
-    can_split = len(selected_subtypes) == 2
-    split_violins = st.checkbox("Split violins (`split=True`)", value=True, disabled=not can_split, help="Only works when exactly two subtypes are selected.")
-    
-df_filtered = df[df['Cancer_Subtype'].isin(selected_subtypes)]
-use_split = can_split and split_violins
-
-with col2:
-    st.subheader("Interactive Plot")
-    if not selected_subtypes:
-        st.warning("Please select at least one cancer subtype.")
-    else:
-        fig, ax = plt.subplots(figsize=(10, 7))
-        sns.violinplot(
-            x='Treatment_Group', y=gene_choice, hue='Cancer_Subtype',
-            hue_order=selected_subtypes, data=df_filtered, palette='muted',
-            split=use_split, inner=inner_style, ax=ax
-        )
-        ax.set_title(f'Expression of {gene_choice}', fontsize=16)
-        st.pyplot(fig)
+# Changing the violin options reruns only this panel
+@st.fragment
+def _control_panel():
+    col1, col2 = st.columns([1, 2])
+    with col1:
+        st.subheader("Parameters")
+        gene_choice = st.selectbox("Choose a Gene (`y`):", GENES, index=1)
+        inner_style = st.selectbox("Inner plot style (`inner`):", ('box', 'quartile', 'point', 'stick'), index=0)
+        selected_subtypes = st.multiselect("Choose Subtypes to Compare (`hue`):", options=SUBTYPES, default=SUBTYPES[:2])
+        can_split = len(selected_subtypes) == 2
+        split_violins = st.checkbox("Split violins (`split=True`)", value=True, disabled=not can_split, help="Only works when exactly two subtypes are selected.")
+
+    use_split = can_split and split_violins
+
+    with col2:
+        st.subheader("Interactive Plot")
+        if not selected_subtypes:
+            st.warning("Please select at least one cancer subtype.")
+        else:
+            st.image(session_plot('violin', (10, 7), _draw_violin, df, dataset_key, gene_choice, inner_style, tuple(selected_subtypes), use_split))
+
+_control_panel()
 
 st.header("DISCOVER: The Coding Sandbox")
 st.info("**Scientific Question:** How does `Gene_B` expression compare between `Subtype_A` vs `Subtype_C`? Create a split violin plot with a box plot inside.")
 
-code = st.text_area("Edit your code here:", value="""import seaborn as sns
+code_template = """import seaborn as sns
 import matplotlib.pyplot as plt
 
 subtypes = ['Subtype_A', 'Subtype_C']
@@ -75,18 +85,17 @@ df_plot = df[df['Cancer_Subtype'].isin(subtypes)]
 
 fig, ax = plt.subplots(figsize=(10,7))
 sns.violinplot(
-    x='Treatment_Group', y='Gene_B', hue='Cancer_Subtype',
+    x='Treatment_Group', y='Gene_B', hue='Cancer_Subtype', hue_order=subtypes,
     data=df_plot, split=True, inner='box', palette='pastel', ax=ax
 )
 st.pyplot(fig)
-""", height=300)
-
-if st.button("Run Code"):
-    st.subheader("Your Output")
-    old_stdout, sys.stdout = sys.stdout, StringIO()
-    try:
-        exec(code, {'st': st, 'sns': sns, 'plt': plt, 'pd': pd, 'df': df})
-        st.code(sys.stdout.getvalue(), language='bash')
-    except Exception as e:
-        st.error(f"🚨 An error occurred:\n{e}")
-    sys.stdout = old_stdout
\ No newline at end of file
+"""
+
+@st.fragment
+def _sandbox():
+    code = st.text_area("Edit your code here:", value=code_template, height=300)
+
+    if st.button("Run Code"):
+        run_sandbox(code, {'st': st, 'sns': sns, 'plt': plt, 'pd': pd, 'df': df.copy()})
+
+_sandbox()
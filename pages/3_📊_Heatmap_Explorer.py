@@ -1,10 +1,75 @@
 import streamlit as st
 import pandas as pd
-import seaborn as sns
+import numpy as np
 import matplotlib.pyplot as plt
-from sidebar_datainput import show_sidebar_data_input
-from io import StringIO
-import sys
+from scipy.cluster.hierarchy import linkage, dendrogram
+from sidebar_datainput import show_sidebar_data_input, GENES, SAMPLE_IDS
+from plot_utils import session_plot
+from sandbox import run_sandbox
+
+# Above this many samples, neighbouring columns are averaged before clustering
+MAX_HEATMAP_COLUMNS = 2000
+# Above this many genes, only the most variable ones are clustered and shown
+MAX_HEATMAP_ROWS = 1500
+
+def _top_variance_rows(values, labels):
+    """Keeps the MAX_HEATMAP_ROWS most variable rows, in their original order."""
+    keep = np.sort(np.argpartition(values.var(axis=1), -MAX_HEATMAP_ROWS)[-MAX_HEATMAP_ROWS:])
+    return values[keep], labels[keep]
+
+def _bin_columns(values, labels):
+    """Averages blocks of adjacent columns so at most MAX_HEATMAP_COLUMNS remain; bins are named after their first sample."""
+    factor = -(-values.shape[1] // MAX_HEATMAP_COLUMNS)
+    starts = np.arange(0, values.shape[1], factor)
+    sums = np.add.reduceat(values, starts, axis=1)
+    counts = np.diff(np.append(starts, values.shape[1]))
+    return sums / counts, labels[starts]
+
+# Bounded like generate_data: one entry per cached dataset and z-score setting
+@st.cache_data(max_entries=32)
+def _cluster(_gene_arr, dataset_key, z_score):
+    """Scales the genes x samples matrix and computes the row/column linkages once per dataset."""
+    # One contiguous genes x samples copy, so the row z-score and pdist walk rows without re-copying
+    values, row_labels, col_labels = np.ascontiguousarray(_gene_arr.T), np.asarray(GENES), SAMPLE_IDS
+    if values.shape[0] > MAX_HEATMAP_ROWS:
+        values, row_labels = _top_variance_rows(values, row_labels)
+    if values.shape[1] > MAX_HEATMAP_COLUMNS:
+        values, col_labels = _bin_columns(values, col_labels)
+    if z_score:
+        values = (values - values.mean(axis=1, keepdims=True)) / values.std(axis=1, ddof=1, keepdims=True)
+    return values, row_labels, col_labels, linkage(values, method='average'), linkage(values.T, method='average')
+
+def _draw_heatmap(fig, gene_arr, dataset_key, z_score, cmap, annot, cluster_rows, cluster_cols):
+    """Draws a clustered heatmap onto `fig` from the cached linkages, so only the styling is redone."""
+    values, row_labels, col_labels, row_link, col_link = _cluster(gene_arr, dataset_key, z_score)
+    grid = fig.add_gridspec(2, 2, width_ratios=[0.15, 1], height_ratios=[0.15, 1], wspace=0.02, hspace=0.02)
+    n_rows, n_cols = values.shape
+    row_order, col_order = np.arange(n_rows), np.arange(n_cols)
+    dendro_style = {'no_labels': True, 'color_threshold': 0, 'above_threshold_color': 'k'}
+
+    # Dendrogram leaves sit at 5, 15, 25, ... so the heatmap cells are 10 units wide to line up
+    if cluster_rows:
+        ax_rows = fig.add_subplot(grid[1, 0])
+        row_order = dendrogram(row_link, ax=ax_rows, orientation='left', **dendro_style)['leaves']
+        ax_rows.set_ylim(10 * n_rows, 0)
+        ax_rows.axis('off')
+    if cluster_cols:
+        ax_cols = fig.add_subplot(grid[0, 1])
+        col_order = dendrogram(col_link, ax=ax_cols, orientation='top', **dendro_style)['leaves']
+        ax_cols.set_xlim(0, 10 * n_cols)
+        ax_cols.axis('off')
+
+    ordered = values[np.ix_(row_order, col_order)]
+    ax_heat = fig.add_subplot(grid[1, 1])
+    image = ax_heat.imshow(ordered, cmap=cmap, aspect='auto', interpolation='nearest', extent=(0, 10 * n_cols, 10 * n_rows, 0))
+    ax_heat.set_yticks(10 * np.arange(n_rows) + 5, row_labels[row_order])
+    ax_heat.set_xticks(10 * np.arange(n_cols) + 5, col_labels[col_order], rotation=90, fontsize=6)
+    ax_heat.yaxis.tick_right()
+    if annot:
+        for i, j in np.ndindex(ordered.shape):
+            ax_heat.text(10 * j + 5, 10 * i + 5, f"{ordered[i, j]:.1f}", ha='center', va='center', fontsize=5)
+    # A slim colorbar in the empty top-left corner, as clustermap places it, keeps it clear of the gene labels on the right
+    fig.colorbar(image, cax=fig.add_subplot(grid[0, 0].subgridspec(1, 3, width_ratios=[1, 1, 4])[0, 0]))
 
 # Page configuration
 st.set_page_config(layout="wide")
@@ -18,7 +83,9 @@ if 'df_full' not in st.session_state:
 
 # Load data from session state
 df = st.session_state['df_full']
-gene_data = df[[col for col in df.columns if col.startswith('Gene_')]].T
+dataset_key = st.session_state['dataset_key']
+# The plot reads the samples x genes array stored with the dataset, so no gene columns are selected per rerun
+gene_arr = st.session_state['gene_arr']
 
 # --- Guided Tour Expander (UPDATED) ---
 with st.expander("LEARN: What is a Heatmap?"):
@@ -33,7 +100,7 @@ with st.expander("LEARN: What is a Heatmap?"):
 
     ---
     #### Dive Deeper (External Links):
-    - 🔗 **[Seaborn `clustermap` Documentation](https://seaborn.pydata.org/generated/seaborn.clustermap.html):** This is the function we use. It combines a heatmap with clustering.
+    - 🔗 **[Seaborn `clustermap` Documentation](https://seaborn.pydata.org/generated/seaborn.clustermap.html):** The plot above draws the same clustered heatmap with SciPy and Matplotlib, and the sandbox below uses `clustermap` itself. It combines a heatmap with clustering.
     - 🔗 **[The Python Graph Gallery - Heatmap](https://www.python-graph-gallery.com/heatmap/):** A great resource with many examples and explanations.
     """)
 
@@ -41,35 +108,31 @@ with st.expander("LEARN: What is a Heatmap?"):
 st.header("EXPERIMENT: The Control Panel")
 st.markdown("Use the widgets below to see how parameters change the plot.")
 
-col1, col2 = st.columns([1, 2])
-
-with col1:
-    st.subheader("Parameters")
-    cmap_choice = st.selectbox("Colormap (`cmap`):", ('vlag', 'coolwarm', 'viridis', 'plasma'))
-    show_annot = st.checkbox("Show values (`annot`)", value=False)
-    cluster_rows = st.checkbox("Cluster Rows (Genes)", value=True)
-    cluster_cols = st.checkbox("Cluster Columns (Samples)", value=True)
-    
-    st.info("The most impactful choice is scaling (`z_score`). Notice how without it (z_score=None), a few highly expressed genes dominate the colors, hiding the patterns in other genes.")
-    z_score_option = st.radio("Scale data (Z-score)", ('by Row (Genes)', 'None'), horizontal=True, index=0)
-    z_score_val = 0 if z_score_option == 'by Row (Genes)' else None
-    
-with col2:
-    st.subheader("Interactive Plot")
-    try:
-        g = sns.clustermap(
-            gene_data,
-            cmap=cmap_choice,
-            annot=show_annot,
-            fmt=".1f" if show_annot else None,
-            row_cluster=cluster_rows,
-            col_cluster=cluster_cols,
-            z_score=z_score_val,
-            figsize=(10, 8)
-        )
-        st.pyplot(g)
-    except Exception as e:
-        st.error(f"An error occurred: {e}")
+# Heatmap options rerun just this panel, not the rest of the page
+@st.fragment
+def _control_panel():
+    col1, col2 = st.columns([1, 2])
+
+    with col1:
+        st.subheader("Parameters")
+        cmap_choice = st.selectbox("Colormap (`cmap`):", ('vlag', 'coolwarm', 'viridis', 'plasma'))
+        show_annot = st.checkbox("Show values (`annot`)", value=False)
+        cluster_rows = st.checkbox("Cluster Rows (Genes)", value=True)
+        cluster_cols = st.checkbox("Cluster Columns (Samples)", value=True)
+
+        st.info("The most impactful choice is scaling (`z_score`). Notice how without it (z_score=None), a few highly expressed genes dominate the colors, hiding the patterns in other genes.")
+        z_score_option = st.radio("Scale data (Z-score)", ('by Row (Genes)', 'None'), horizontal=True, index=0)
+        z_score_val = 0 if z_score_option == 'by Row (Genes)' else None
+
+    with col2:
+        st.subheader("Interactive Plot")
+        try:
+            # The clustering is cached, so changing the colormap or annotations only redraws the figure
+            st.image(session_plot('heatmap', (10, 8), _draw_heatmap, gene_arr, dataset_key, z_score_val == 0, cmap_choice, show_annot, cluster_rows, cluster_cols))
+        except Exception as e:
+            st.error(f"An error occurred: {e}")
+
+_control_panel()
 
 # --- Coding Sandbox ---
 st.header("DISCOVER: The Coding Sandbox")
@@ -93,26 +156,14 @@ fig = sns.clustermap(
 st.pyplot(fig)
 """
 
-code = st.text_area("Edit your Python code here:", value=code_template, height=300)
-
-if st.button("Run Code", type="primary"):
-    st.subheader("Your Output")
-    
-    # Redirect stdout to capture print statements
-    old_stdout = sys.stdout
-    sys.stdout = captured_output = StringIO()
-    
-    try:
-        # The locals dict makes our data available to the executed code
-        exec(code, {'st': st, 'sns': sns, 'plt': plt, 'gene_data': gene_data})
-        
-        # Get the output from the buffer
-        console_output = captured_output.getvalue()
-        if console_output:
-            st.code(console_output, language='bash')
-            
-    except Exception as e:
-        st.error(f"🚨 An error occurred:\n{e}")
-
-    # Restore stdout
-    sys.stdout = old_stdout
\ No newline at end of file
+@st.fragment
+def _sandbox():
+    code = st.text_area("Edit your Python code here:", value=code_template, height=300)
+
+    if st.button("Run Code", type="primary"):
+        import seaborn as sns
+        # Built genes x samples from the stored array; the copy keeps the sandbox from touching the session data
+        gene_data = pd.DataFrame(np.ascontiguousarray(gene_arr.T), index=list(GENES), columns=df.index)
+        run_sandbox(code, {'st': st, 'sns': sns, 'plt': plt, 'gene_data': gene_data})
+
+_sandbox()
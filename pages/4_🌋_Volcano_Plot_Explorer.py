@@ -1,10 +1,49 @@
 import streamlit as st
 import pandas as pd
-import seaborn as sns
+import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgba_array
+from matplotlib.lines import Line2D
 from sidebar_datainput import show_sidebar_data_input
-from io import StringIO
-import sys
+from plot_utils import session_plot
+from sandbox import run_sandbox
+
+SIGNIFICANCE_ORDER = ['Upregulated', 'Downregulated', 'Not Significant']
+SIGNIFICANCE_COLORS = to_rgba_array(['red', 'blue', '#BBBBBB'], alpha=0.7)
+
+# Bounded, as every submitted threshold pair on every dataset adds an entry
+@st.cache_data(max_entries=64)
+def _classify(_df, dataset_key, pval_thresh, fc_thresh):
+    """Labels every gene as up-/downregulated or not significant and counts the genes in each label."""
+    fc = _df['log2_Fold_Change'].to_numpy()
+    significant = _df['neg_log10_p_value'].to_numpy() > pval_thresh
+    codes = np.select([significant & (fc > fc_thresh), significant & (fc < -fc_thresh)], [0, 1], default=2).astype(np.int8)
+    significance = pd.Series(pd.Categorical.from_codes(codes, categories=SIGNIFICANCE_ORDER), index=_df.index, name='Significance')
+    # The counts come straight from the codes, so the hits table needs no second pass over the labels
+    counts = pd.Series(np.bincount(codes, minlength=len(SIGNIFICANCE_ORDER)), index=pd.Index(SIGNIFICANCE_ORDER, name='Significance'), name='count')
+    # Labels with no genes are left out, as value_counts did
+    return significance, counts[counts > 0].sort_values(ascending=False, kind='stable')
+
+def _draw_volcano(fig, df_volcano, dataset_key, pval_thresh, fc_thresh):
+    """Draws the interactive volcano plot onto `fig`."""
+    significance, _ = _classify(df_volcano, dataset_key, pval_thresh, fc_thresh)
+    ax = fig.add_subplot()
+    
+    # A single rasterized collection colored by the category codes; the legend uses proxy handles
+    ax.scatter(
+        df_volcano['log2_Fold_Change'].to_numpy(), df_volcano['neg_log10_p_value'].to_numpy(),
+        c=SIGNIFICANCE_COLORS[significance.cat.codes.to_numpy()], s=20, edgecolors='white', linewidths=0.5, rasterized=True
+    )
+    ax.legend(
+        handles=[Line2D([], [], marker='o', linestyle='None', color=color, label=label) for label, color in zip(SIGNIFICANCE_ORDER, SIGNIFICANCE_COLORS)],
+        title='Significance'
+    )
+    ax.set_xlabel('log2_Fold_Change')
+    ax.set_ylabel('neg_log10_p_value')
+    ax.axhline(y=pval_thresh, color='k', linestyle='--', lw=1)
+    ax.axvline(x=fc_thresh, color='k', linestyle='--', lw=1)
+    ax.axvline(x=-fc_thresh, color='k', linestyle='--', lw=1)
+    ax.set_title('Volcano Plot of Differential Gene Expression')
 
 # Page configuration
 st.set_page_config(layout="wide")
@@ -18,6 +57,7 @@ if 'df_volcano' not in st.session_state:
 
 # Load data from session state
 df_volcano = st.session_state['df_volcano']
+dataset_key = st.session_state['dataset_key']
 
 # --- Guided Tour Expander (UPDATED) ---
 with st.expander("LEARN: What is a Volcano Plot?"):
@@ -46,48 +86,39 @@ with st.expander("LEARN: What is a Volcano Plot?"):
 st.header("EXPERIMENT: The Control Panel")
 st.markdown("Use the sliders to see how changing significance thresholds impacts which genes are identified as hits.")
 
-col1, col2 = st.columns([1, 2])
-
-with col1:
-    st.subheader("Parameters")
-    pval_thresh = st.slider(
-        "Significance Threshold (-log10 P-value)",
-        min_value=0.0, max_value=10.0, value=2.0, step=0.1,
-        help="Higher values make the significance test more strict."
-    )
-    fc_thresh = st.slider(
-        "Fold Change Threshold (log2)",
-        min_value=0.0, max_value=5.0, value=1.0, step=0.1,
-        help="Filters for genes with at least this magnitude of change."
-    )
-    
-    # Create a dynamic copy for the interactive plot
-    df_interactive = df_volcano.copy()
-    df_interactive['Significance'] = 'Not Significant'
-    up_cond = (df_interactive['log2_Fold_Change'] > fc_thresh) & (df_interactive['neg_log10_p_value'] > pval_thresh)
-    down_cond = (df_interactive['log2_Fold_Change'] < -fc_thresh) & (df_interactive['neg_log10_p_value'] > pval_thresh)
-    df_interactive.loc[up_cond, 'Significance'] = 'Upregulated'
-    df_interactive.loc[down_cond, 'Significance'] = 'Downregulated'
-    
-    # Display summary
-    st.write("Genes selected as hits:")
-    st.table(df_interactive['Significance'].value_counts())
-
-with col2:
-    st.subheader("Interactive Plot")
-    fig, ax = plt.subplots(figsize=(9, 7))
-    custom_palette = {'Upregulated':'red', 'Downregulated':'blue', 'Not Significant':'#BBBBBB'}
-    
-    sns.scatterplot(
-        data=df_interactive, x='log2_Fold_Change', y='neg_log10_p_value',
-        hue='Significance', palette=custom_palette, s=20, alpha=0.7, ax=ax,
-        hue_order=['Upregulated', 'Downregulated', 'Not Significant']
-    )
-    ax.axhline(y=pval_thresh, color='k', linestyle='--', lw=1)
-    ax.axvline(x=fc_thresh, color='k', linestyle='--', lw=1)
-    ax.axvline(x=-fc_thresh, color='k', linestyle='--', lw=1)
-    ax.set_title('Volcano Plot of Differential Gene Expression', fontsize=16)
-    st.pyplot(fig)
+# Submitting new thresholds reruns only this panel
+@st.fragment
+def _control_panel():
+    col1, col2 = st.columns([1, 2])
+
+    with col1:
+        st.subheader("Parameters")
+        # Inside a form, dragging a slider doesn't rerun the page; the new thresholds apply on submit
+        with st.form("volcano_params"):
+            pval_thresh = st.slider(
+                "Significance Threshold (-log10 P-value)",
+                min_value=0.0, max_value=10.0, value=2.0, step=0.1,
+                help="Higher values make the significance test more strict."
+            )
+            fc_thresh = st.slider(
+                "Fold Change Threshold (log2)",
+                min_value=0.0, max_value=5.0, value=1.0, step=0.1,
+                help="Filters for genes with at least this magnitude of change."
+            )
+            st.form_submit_button("Apply thresholds")
+
+        # Classify the genes without touching the cached DataFrame
+        _, hit_counts = _classify(df_volcano, dataset_key, pval_thresh, fc_thresh)
+
+        # Display summary
+        st.write("Genes selected as hits:")
+        st.table(hit_counts)
+
+    with col2:
+        st.subheader("Interactive Plot")
+        st.image(session_plot('volcano', (9, 7), _draw_volcano, df_volcano, dataset_key, pval_thresh, fc_thresh))
+
+_control_panel()
 
 
 # --- Coding Sandbox ---
@@ -131,17 +162,12 @@ if not upregulated_genes.empty:
 st.pyplot(fig)
 """
 
-code = st.text_area("Edit your Python code here:", value=code_template, height=400)
-
-if st.button("Run Code", type="primary"):
-    st.subheader("Your Output")
-    old_stdout = sys.stdout
-    sys.stdout = captured_output = StringIO()
-    try:
-        exec(code, {'st': st, 'sns': sns, 'plt': plt, 'pd': pd, 'df_volcano': df_volcano})
-        console_output = captured_output.getvalue()
-        if console_output:
-            st.code(console_output, language='bash')
-    except Exception as e:
-        st.error(f"🚨 An error occurred:\n{e}")
-    sys.stdout = old_stdout
\ No newline at end of file
+@st.fragment
+def _sandbox():
+    code = st.text_area("Edit your Python code here:", value=code_template, height=400)
+
+    if st.button("Run Code", type="primary"):
+        import seaborn as sns
+        run_sandbox(code, {'st': st, 'sns': sns, 'plt': plt, 'pd': pd, 'df_volcano': df_volcano.copy()})
+
+_sandbox()
@@ -1,10 +1,52 @@
 import streamlit as st
 import pandas as pd
-from lifelines import KaplanMeierFitter
+import numpy as np
 import matplotlib.pyplot as plt
 from sidebar_datainput import show_sidebar_data_input
-from io import StringIO
-import sys
+from plot_utils import session_plot
+from sandbox import run_sandbox
+
+# One entry per dataset, capped like generate_data
+@st.cache_data(max_entries=16)
+def _km(_df, _group_masks, dataset_key):
+    """Kaplan-Meier estimates with exponential Greenwood 95% CIs (as in lifelines) for every treatment group."""
+    times = _df['Survival_Time_days'].to_numpy()
+    events = _df['Event_Status'].to_numpy()
+    curves = {}
+    for group, mask in _group_masks.items():
+        t, idx = np.unique(times[mask], return_inverse=True)
+        deaths = np.bincount(idx, weights=events[mask])
+        at_risk = mask.sum() - np.concatenate([[0], np.cumsum(np.bincount(idx))[:-1]])
+        surv = np.cumprod(1 - deaths / at_risk)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = np.cumsum(deaths / (at_risk * (at_risk - deaths))) / np.log(surv) ** 2
+            ci_low = np.where(surv < 1, surv ** np.exp(1.96 * np.sqrt(var)), 1.0)
+            ci_high = np.where(surv < 1, surv ** np.exp(-1.96 * np.sqrt(var)), 1.0)
+        censored = np.unique(times[mask & (events == 0)])
+        curves[group] = (
+            np.concatenate([[0], t]), np.concatenate([[1.0], surv]),
+            np.concatenate([[1.0], ci_low]), np.concatenate([[1.0], ci_high]),
+            censored, surv[np.searchsorted(t, censored)]
+        )
+    return curves
+
+def _draw_survival(fig, df, dataset_key, ci_show, show_censor_ticks, censor_tick_size):
+    """Draws the cached KM curves onto `fig`."""
+    ax = fig.add_subplot()
+    
+    # The curves are estimated once per dataset; the checkboxes only change what gets drawn
+    curves = _km(df, st.session_state['group_masks'], dataset_key)
+    for group, (t, surv, ci_low, ci_high, censor_t, censor_surv) in curves.items():
+        line, = ax.step(t, surv, where='post', label=group)
+        if ci_show:
+            ax.fill_between(t, ci_low, ci_high, step='post', color=line.get_color(), alpha=0.3, lw=0)
+        if show_censor_ticks:
+            ax.plot(censor_t, censor_surv, linestyle='None', marker='|', ms=censor_tick_size, color=line.get_color())
+    
+    ax.set_title('Kaplan-Meier Survival Curves by Treatment Group')
+    ax.set_xlabel('Time (Days)', fontsize=12)
+    ax.set_ylabel('Survival Probability', fontsize=12)
+    ax.legend(title='Group')
 
 # Page configuration
 st.set_page_config(layout="wide")
@@ -18,6 +60,7 @@ if 'df_full' not in st.session_state:
 
 # Load data from session state
 df = st.session_state['df_full']
+dataset_key = st.session_state['dataset_key']
 
 # --- Guided Tour Expander (UPDATED) ---
 with st.expander("LEARN: What is a Survival Plot?"):
@@ -41,45 +84,31 @@ with st.expander("LEARN: What is a Survival Plot?"):
 st.header("EXPERIMENT: The Control Panel")
 st.markdown("Experiment with the plot's appearance and see how the 'Survival Benefit' from the Data Lab changes the story.")
 
-col1, col2 = st.columns([1, 2])
+# The survival plot options rerun only this panel
+@st.fragment
+def _control_panel():
+    col1, col2 = st.columns([1, 2])
 
-with col1:
-    st.subheader("Parameters")
-    ci_show = st.checkbox("Show 95% Confidence Interval (`ci_show`)", value=True)
-    
-    # *** THE FIX IS HERE: Use show_censors for the main toggle ***
-    show_censor_ticks = st.checkbox("Show censor ticks (`show_censors`)", value=True)
-    
-    # Add a slider to control the size of the ticks, which is more intuitive
-    censor_tick_size = st.slider(
-        "Censor tick size (`censor_styles`)", 
-        min_value=1, max_value=15, value=6,
-        disabled=not show_censor_ticks # Disable if ticks are hidden
-    )
-    st.info("The Confidence Interval shows the uncertainty in our estimate. If the intervals for two groups do not overlap, it suggests a significant difference.")
-
-with col2:
-    st.subheader("Interactive Plot")
-    fig, ax = plt.subplots(figsize=(8, 6))
-    kmf = KaplanMeierFitter()
-    
-    for group in df['Treatment_Group'].unique():
-        mask = df['Treatment_Group'] == group
-        kmf.fit(df[mask]['Survival_Time_days'], df[mask]['Event_Status'], label=group)
-        
-        # *** THE FIX IS HERE: Pass the boolean directly to show_censors ***
-        kmf.plot_survival_function(
-            ax=ax,
-            ci_show=ci_show,
-            show_censors=show_censor_ticks,
-            censor_styles={'ms': censor_tick_size, 'marker': '|'} # Style is now separate
+    with col1:
+        st.subheader("Parameters")
+        ci_show = st.checkbox("Show 95% Confidence Interval (`ci_show`)", value=True)
+
+        # *** THE FIX IS HERE: Use show_censors for the main toggle ***
+        show_censor_ticks = st.checkbox("Show censor ticks (`show_censors`)", value=True)
+
+        # Add a slider to control the size of the ticks, which is more intuitive
+        censor_tick_size = st.slider(
+            "Censor tick size (`censor_styles`)", 
+            min_value=1, max_value=15, value=6,
+            disabled=not show_censor_ticks # Disable if ticks are hidden
         )
-    
-    ax.set_title('Kaplan-Meier Survival Curves by Treatment Group', fontsize=16)
-    ax.set_xlabel('Time (Days)', fontsize=12)
-    ax.set_ylabel('Survival Probability', fontsize=12)
-    ax.legend(title='Group')
-    st.pyplot(fig)
+        st.info("The Confidence Interval shows the uncertainty in our estimate. If the intervals for two groups do not overlap, it suggests a significant difference.")
+
+    with col2:
+        st.subheader("Interactive Plot")
+        st.image(session_plot('survival', (8, 6), _draw_survival, df, dataset_key, ci_show, show_censor_ticks, censor_tick_size))
+
+_control_panel()
 
 
 # --- Coding Sandbox (Also updated to reflect best practice) ---
@@ -119,17 +148,12 @@ ax.set_title('Customized Survival Plot', fontsize=16)
 st.pyplot(fig)
 """
 
-code = st.text_area("Edit your Python code here:", value=code_template, height=400)
-
-if st.button("Run Code", type="primary"):
-    st.subheader("Your Output")
-    old_stdout = sys.stdout
-    sys.stdout = captured_output = StringIO()
-    try:
-        exec(code, {'st': st, 'plt': plt, 'KaplanMeierFitter': KaplanMeierFitter, 'df': df})
-        console_output = captured_output.getvalue()
-        if console_output:
-            st.code(console_output, language='bash')
-    except Exception as e:
-        st.error(f"🚨 An error occurred:\n{e}")
-    sys.stdout = old_stdout
\ No newline at end of file
+@st.fragment
+def _sandbox():
+    code = st.text_area("Edit your Python code here:", value=code_template, height=400)
+
+    if st.button("Run Code", type="primary"):
+        from lifelines import KaplanMeierFitter # Only the sandbox needs lifelines, so it is imported on first use
+        run_sandbox(code, {'st': st, 'plt': plt, 'KaplanMeierFitter': KaplanMeierFitter, 'df': df.copy()})
+
+_sandbox()
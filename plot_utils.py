@@ -0,0 +1,28 @@
+import io
+import matplotlib
+import streamlit as st
+from matplotlib.figure import Figure
+
+# All pages render off-screen, so pin the non-interactive backend and set the shared styling once on import
+matplotlib.use('Agg')
+matplotlib.rcParams.update({'axes.titlesize': 16})
+
+# Same resolution and cropping that st.pyplot uses, so the plots look unchanged
+PNG_SAVEFIG_KWARGS = {'format': 'png', 'dpi': 200, 'bbox_inches': 'tight'}
+
+# Each page keeps one Figure per session and only redraws it when its plot parameters change
+def session_plot(name, figsize, draw, data, *params):
+    """Returns the page's plot as PNG bytes, redrawn with `draw(fig, data, *params)` only when `params` changed."""
+    fig_key, params_key, png_key = f'{name}_fig', f'{name}_fig_params', f'{name}_fig_png'
+    if fig_key not in st.session_state:
+        # A plain Figure is not registered with pyplot, so it is never leaked into its global figure list
+        st.session_state[fig_key] = Figure(figsize=figsize)
+    fig = st.session_state[fig_key]
+    if st.session_state.get(params_key) != params:
+        fig.clear()
+        draw(fig, data, *params)
+        buffer = io.BytesIO()
+        fig.savefig(buffer, **PNG_SAVEFIG_KWARGS)
+        st.session_state[png_key] = buffer.getvalue()
+        st.session_state[params_key] = params
+    return st.session_state[png_key]
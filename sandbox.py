@@ -0,0 +1,61 @@
+import streamlit as st
+from contextlib import contextmanager
+from io import StringIO
+import functools
+import sys
+import threading
+
+class _ThreadLocalStdout:
+    """Stands in for sys.stdout and sends each thread's writes to its own capture buffer, if it has one."""
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def _target(self):
+        buffer = getattr(self._local, 'buffer', None)
+        return self._stream if buffer is None else buffer
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        return self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    @contextmanager
+    def capture(self, buffer):
+        """Redirects this thread's output into `buffer`, leaving every other session's thread untouched."""
+        previous = getattr(self._local, 'buffer', None)
+        self._local.buffer = buffer
+        try:
+            yield buffer
+        finally:
+            self._local.buffer = previous
+
+# Streamlit runs every session in its own thread, so sys.stdout is replaced once with a per-thread proxy
+# instead of being swapped (and possibly restored out of order) around each sandbox run
+if not isinstance(sys.stdout, _ThreadLocalStdout):
+    sys.stdout = _ThreadLocalStdout(sys.stdout)
+_stdout = sys.stdout
+
+@functools.lru_cache(maxsize=64)
+def _compile_sandbox(code):
+    """Compiles the sandbox source once per distinct text, so re-running unchanged code skips parsing."""
+    return compile(code, '<sandbox>', 'exec')
+
+# Shared runner for the "DISCOVER: The Coding Sandbox" section of every page
+def run_sandbox(code, namespace):
+    """Executes the student's `code` with `namespace` as its globals and shows printed output or the error."""
+    st.subheader("Your Output")
+    captured_output = StringIO()
+    try:
+        # Restores this thread's stdout even if the code raises something Exception does not catch (e.g. SystemExit)
+        with _stdout.capture(captured_output):
+            exec(_compile_sandbox(code), namespace)
+        console_output = captured_output.getvalue()
+        if console_output:
+            st.code(console_output, language='bash')
+    except Exception as e:
+        st.error(f"🚨 An error occurred:\n{e}")
@@ -2,45 +2,116 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 
-# This function will contain our data generation logic
-@st.cache_data
+# Fixed by the simulation, so pages can build their widgets without scanning the DataFrame
+GENES = tuple(f'Gene_{chr(65+i)}' for i in range(10))
+TREATMENT_GROUPS = ('Control', 'Treated')
+SUBTYPES = ('Subtype_A', 'Subtype_B', 'Subtype_C')
+# (treatment effect, survival benefit, gene correlation, significant genes) for each preset scenario
+SCENARIO_PRESETS = {
+    "Textbook Case (Clear Effects)": (2.5, 1.5, 0.8, 100),
+    "Subtle Effects (More Realistic)": (0.8, 0.5, 0.4, 20),
+    "Failed Drug Trial (No Survival Benefit)": (2.5, 0.0, 0.8, 100),
+}
+SCENARIO_PARAM_LABELS = ('Treatment Effect', 'Survival Benefit', 'Gene Correlation', 'Significant Genes')
+# Every new session starts on the Textbook scenario with the fixed seed
+DEFAULT_PARAMS = (*SCENARIO_PRESETS["Textbook Case (Clear Effects)"], 42)
+NUM_SAMPLES = 100
+NUM_DE_GENES = 1000
+# The ID columns never change with the parameters, so they are built once, with NumPy string ops, on import
+SAMPLE_IDS = np.char.add('Sample_', np.arange(1, NUM_SAMPLES + 1).astype(str))
+DE_GENE_IDS = np.char.add('Gene_', np.arange(NUM_DE_GENES).astype(str))
+
+# This function will contain our data generation logic; the in-memory cache is capped so slider sweeps
+# can't grow it without bound
+@st.cache_data(max_entries=16, show_spinner=False)
 def generate_data(treatment_effect, survival_benefit, correlation_strength, num_hits, random_seed):
     """Generates all the simulated data for the app."""
-    np.random.seed(random_seed)
-    num_samples = 100
-    genes = [f'Gene_{chr(65+i)}' for i in range(10)]
-    df_meta = pd.DataFrame({
-        'Sample_ID': [f'Sample_{i+1}' for i in range(num_samples)],
-        'Treatment_Group': np.random.choice(['Control', 'Treated'], num_samples, p=[0.5, 0.5]),
-        'Cancer_Subtype': np.random.choice(['Subtype_A', 'Subtype_B', 'Subtype_C'], num_samples, p=[0.4, 0.35, 0.25])
-    })
-    expression_data = np.log2(np.random.uniform(10, 100, size=(num_samples, len(genes))))
-    df_expr = pd.DataFrame(expression_data, columns=genes)
-    df_full = pd.concat([df_meta, df_expr], axis=1)
-    treated_indices = df_full['Treatment_Group'] == 'Treated'
-    df_full.loc[treated_indices, 'Gene_B'] += np.random.normal(treatment_effect, 0.5, size=treated_indices.sum())
-    df_full.loc[treated_indices, 'Gene_C'] += np.random.normal(treatment_effect * 1.2, 0.5, size=treated_indices.sum())
-    df_full.loc[treated_indices, 'Gene_H'] -= np.random.normal(treatment_effect * 0.8, 0.5, size=treated_indices.sum())
-    df_full['Gene_E'] = df_full['Gene_D'] * correlation_strength + np.random.normal(0, 2 * (1 - correlation_strength), num_samples)
-    base_survival = np.random.exponential(365, num_samples)
-    treatment_benefit_days = (df_full['Treatment_Group'] == 'Treated') * np.random.exponential(365 * survival_benefit, num_samples)
-    df_full['Survival_Time_days'] = (base_survival + treatment_benefit_days).astype(int)
+    rng = np.random.default_rng(random_seed)
+    num_samples = NUM_SAMPLES
+    genes = list(GENES)
+    # Integer codes are drawn and wrapped as categoricals directly, so no object array of strings is built;
+    # the fixed category lists keep every group present in masks and legends, even if a draw never picks it
+    treatment_codes = rng.integers(0, len(TREATMENT_GROUPS), num_samples, dtype=np.int8)
+    subtype_codes = rng.choice(len(SUBTYPES), num_samples, p=[0.4, 0.35, 0.25]).astype(np.int8)
+    treatment_group = pd.Categorical.from_codes(treatment_codes, categories=TREATMENT_GROUPS)
+    cancer_subtype = pd.Categorical.from_codes(subtype_codes, categories=SUBTYPES)
+    # float32 halves the expression footprint and is plenty for log2 values that are only plotted;
+    # the log is taken in place on the float32 draw, so there is no float64 temporary
+    expression_data = rng.uniform(10, 100, size=(num_samples, len(genes))).astype(np.float32)
+    np.log(expression_data, out=expression_data)
+    expression_data *= np.float32(1 / np.log(2))
+    treated_indices = treatment_codes == TREATMENT_GROUPS.index('Treated')
+    # One batched draw shifts Gene_B and Gene_C up and Gene_H down in the treated group, added straight into the array
+    treatment_shift = rng.standard_normal((treated_indices.sum(), 3), dtype=np.float32)
+    treatment_shift *= 0.5
+    treatment_shift += np.array([1.0, 1.2, -0.8], dtype=np.float32) * np.float32(treatment_effect)
+    expression_data[np.ix_(treated_indices, [genes.index(g) for g in ('Gene_B', 'Gene_C', 'Gene_H')])] += treatment_shift
+    # Elementwise math runs in place on the raw arrays to avoid pandas temporaries
+    gene_e = rng.normal(0, 2 * (1 - correlation_strength), num_samples)
+    gene_e += correlation_strength * expression_data[:, genes.index('Gene_D')]
+    expression_data[:, genes.index('Gene_E')] = gene_e
+    survival_days = rng.exponential(365, num_samples)
+    # The treatment bonus is only drawn for, and added in place to, the treated patients
+    survival_days[treated_indices] += rng.exponential(365 * survival_benefit, np.count_nonzero(treated_indices))
     study_cutoff = 365 * 4
-    df_full['Event_Status'] = 1
-    df_full.loc[df_full['Survival_Time_days'] > study_cutoff, 'Event_Status'] = 0
-    df_full.loc[df_full['Survival_Time_days'] > study_cutoff, 'Survival_Time_days'] = study_cutoff
-    num_genes_total = 1000
-    genes_de = [f'Gene_{i}' for i in range(num_genes_total)]
-    log2fc = np.random.normal(0, 0.5, num_genes_total)
-    if num_hits > 0:
-        significant_indices = np.random.choice(num_genes_total, num_hits, replace=False)
-        log2fc[significant_indices] = np.random.normal(0, 2.5, num_hits)
-    p_values = -np.log10(np.random.uniform(0.05, 1, num_genes_total))
-    if num_hits > 0:
-        p_values[significant_indices] = -np.log10(np.random.uniform(1e-12, 1e-4, num_hits))
-    df_volcano = pd.DataFrame({'gene_id': genes_de, 'log2_Fold_Change': log2fc, 'neg_log10_p_value': p_values})
+    # Patients still alive at the cutoff are censored there. Clipping happens before the int16 cast,
+    # as raw draws can exceed its range; `>= cutoff + 1` matches the whole days kept by the cast
+    still_alive = survival_days >= study_cutoff + 1
+    np.minimum(survival_days, study_cutoff, out=survival_days)
+    survival_days = survival_days.astype(np.int16)
+    # Every column is ready, so the DataFrame is built once with no concat
+    columns = {
+        'Sample_ID': SAMPLE_IDS,
+        'Treatment_Group': treatment_group,
+        'Cancer_Subtype': cancer_subtype,
+        **{gene: expression_data[:, i] for i, gene in enumerate(genes)},
+        'Survival_Time_days': survival_days,
+        'Event_Status': (~still_alive).astype(np.int8)
+    }
+    df_full = pd.DataFrame(columns)
+    num_genes_total = NUM_DE_GENES
+    # Background and hit genes are drawn separately straight into their slots, so no draw is overwritten
+    significant = np.zeros(num_genes_total, dtype=bool)
+    significant[rng.choice(num_genes_total, num_hits, replace=False)] = True
+    log2fc = np.empty(num_genes_total)
+    p_values = np.empty(num_genes_total)
+    log2fc[~significant] = rng.normal(0, 0.5, num_genes_total - num_hits)
+    p_values[~significant] = rng.uniform(0.05, 1, num_genes_total - num_hits)
+    log2fc[significant] = rng.normal(0, 2.5, num_hits)
+    p_values[significant] = rng.uniform(1e-12, 1e-4, num_hits)
+    # A single in-place pass turns the raw p-values into -log10(p)
+    np.log10(p_values, out=p_values)
+    np.negative(p_values, out=p_values)
+    df_volcano = pd.DataFrame({'gene_id': DE_GENE_IDS, 'log2_Fold_Change': log2fc, 'neg_log10_p_value': p_values})
     return df_full, df_volcano
 
+@st.cache_resource
+def _default_dataset():
+    """The default dataset, built once per server and shared by every session without unpickling."""
+    return generate_data(*DEFAULT_PARAMS)
+
+def _store_dataset(params):
+    """Generates the datasets for `params` and stores them, keyed by those params, in the session; returns whether anything changed."""
+    # Re-clicking with unchanged parameters keeps the current data (and every plot cached on it)
+    if st.session_state.get('dataset_key') == params and 'df_full' in st.session_state:
+        return False
+    if params == DEFAULT_PARAMS:
+        # Shallow copies, so adding or dropping a column in one session can't change the shared frames
+        df_full, df_volcano = (df.copy(deep=False) for df in _default_dataset())
+    else:
+        df_full, df_volcano = generate_data(*params)
+    st.session_state['df_full'] = df_full
+    st.session_state['df_volcano'] = df_volcano
+    st.session_state['group_masks'] = {g: (df_full['Treatment_Group'] == g).to_numpy() for g in df_full['Treatment_Group'].cat.categories}
+    st.session_state['subtype_masks'] = {s: (df_full['Cancer_Subtype'] == s).to_numpy() for s in df_full['Cancer_Subtype'].cat.categories}
+    # One contiguous samples x genes array, in the order of GENES, for the numeric plot paths
+    st.session_state['gene_arr'] = np.ascontiguousarray(df_full[list(GENES)].to_numpy())
+    # Only 10 genes, so every pairwise Pearson r is computed up front and just looked up by the pages
+    st.session_state['corr_mat'] = pd.DataFrame(np.corrcoef(st.session_state['gene_arr'], rowvar=False), index=GENES, columns=GENES)
+    # The data is fully determined by its parameters, so they identify it for any cached plot
+    st.session_state['dataset_key'] = params
+    return True
+
 # This function contains all our sidebar controls
 def show_sidebar_data_input():
     with st.sidebar:
@@ -49,7 +120,7 @@ def show_sidebar_data_input():
         
         scenario = st.radio(
             "Choose a data scenario:",
-            ("Textbook Case (Clear Effects)", "Subtle Effects (More Realistic)", "Failed Drug Trial (No Survival Benefit)", "Custom"),
+            (*SCENARIO_PRESETS, "Custom"),
             key='scenario_choice',
             index=0
         )
@@ -61,26 +132,17 @@ def show_sidebar_data_input():
             param_correlation_strength = st.slider("Gene Correlation", 0.0, 1.0, 0.8, 0.05, key='p_cs')
             param_num_hits = st.slider("Significant Genes", 0, 200, 100, 10, key='p_nh')
         else:
-            if scenario == "Textbook Case (Clear Effects)":
-                params = {'Treatment Effect': 2.5, 'Survival Benefit': 1.5, 'Gene Correlation': 0.8, 'Significant Genes': 100}
-                param_treatment_effect, param_survival_benefit, param_correlation_strength, param_num_hits = 2.5, 1.5, 0.8, 100
-            elif scenario == "Subtle Effects (More Realistic)":
-                params = {'Treatment Effect': 0.8, 'Survival Benefit': 0.5, 'Gene Correlation': 0.4, 'Significant Genes': 20}
-                param_treatment_effect, param_survival_benefit, param_correlation_strength, param_num_hits = 0.8, 0.5, 0.4, 20
-            else: # Failed Drug Trial
-                params = {'Treatment Effect': 2.5, 'Survival Benefit': 0.0, 'Gene Correlation': 0.8, 'Significant Genes': 100}
-                param_treatment_effect, param_survival_benefit, param_correlation_strength, param_num_hits = 2.5, 0.0, 0.8, 100
-            st.json(params)
+            preset = SCENARIO_PRESETS[scenario]
+            param_treatment_effect, param_survival_benefit, param_correlation_strength, param_num_hits = preset
+            st.json(dict(zip(SCENARIO_PARAM_LABELS, preset)))
         
         # We use a button to explicitly generate the data and store it in the session
         if st.button("🔬 Generate/Update Dataset", type="primary"):
-            df_full, df_volcano = generate_data(param_treatment_effect, param_survival_benefit, param_correlation_strength, param_num_hits, 42)
-            st.session_state['df_full'] = df_full
-            st.session_state['df_volcano'] = df_volcano
-            st.success("✅ Dataset is ready!")
+            if _store_dataset((param_treatment_effect, param_survival_benefit, param_correlation_strength, param_num_hits, 42)):
+                st.success("✅ Dataset is ready!")
+            else:
+                st.info("✅ Dataset is already up to date with these parameters.")
 
         # Initialize data on first run if it doesn't exist
         if 'df_full' not in st.session_state:
-            df_full, df_volcano = generate_data(2.5, 1.5, 0.8, 100, 42) # Default "Textbook"
-            st.session_state['df_full'] = df_full
-            st.session_state['df_volcano'] = df_volcano
\ No newline at end of file
+            _store_dataset(DEFAULT_PARAMS) # Default "Textbook"
\ No newline at end of file